@@ -1,51 +1,50 @@
 #!/usr/bin/env python3
-import subprocess
 import os
-import json
 import sys
 import logging
 
+from media_probe import get_pair_durations
+
 # Setup logging
-logging.basicConfig(level=logging.DEBUG, handlers=[logging.StreamHandler()])
+logging.basicConfig(level=os.environ.get('SYNC_LOG_LEVEL', 'INFO').upper(), handlers=[logging.StreamHandler()])
 logger = logging.getLogger(__name__)
 
+# Offsets below SYNC_THRESHOLD seconds are left alone, offsets above SYNC_MAX (disabled by default)
+# point to broken input and are not fixed either
+SYNC_THRESHOLD = float(os.environ.get('SYNC_THRESHOLD', '0.1'))
+SYNC_MAX = float(os.environ.get('SYNC_MAX', 'inf'))
+
 presenter = sys.argv[1]
 presentation = sys.argv[2]
 outputfile = sys.argv[3]
 
-def get_audio_duration(filename):
-    logger.debug("Getting audio duration for: %s", filename)
-    result = subprocess.run([
-        'ffprobe', '-v', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=duration',
-        '-of', 'json',
-        filename
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    info = json.loads(result.stdout)
-    return float(info['streams'][0]['duration'])
-
 def determine_sync_status(presenter, presentation):
-    a1 = get_audio_duration(presenter)
-    a2 = get_audio_duration(presentation)
+    (a1, _), (a2, _) = get_pair_durations(presenter, presentation)
     offset = abs(a1 - a2)
-    status = "no-fix-needed" if offset < 0.1 else "fix-needed"
+    status = "no-fix-needed" if offset < SYNC_THRESHOLD else "fix-needed"
 
-    if offset < 0.1:
+    if offset < SYNC_THRESHOLD:
+        fixed_type = "none"
+    elif offset > SYNC_MAX:
+        logger.warning("Offset of %.2fs exceeds the maximum of %.2fs, not fixing.", offset, SYNC_MAX)
+        status = "offset-too-large"
         fixed_type = "none"
     else:
         fixed_type = "presenter" if a1 < a2 else "presentation"
 
-    return status, fixed_type, offset
+    return status, fixed_type, offset, a1, a2
 
-def write_properties(status, fixed_type, offset, outputfile):
+def write_properties(status, fixed_type, offset, outputfile, presenter_duration, presentation_duration):
     with open(outputfile, "w", encoding="utf-8") as f:
         f.write(f"sync_status={status}\n")
         f.write(f"sync_video={fixed_type}\n")
         f.write(f"offset.seconds={offset:.2f}\n")
+        # Durations are passed on to sync_video.py so it does not need to probe again.
+        # No dots in the keys, the workflow reads them as ${presenter_duration} etc.
+        f.write(f"presenter_duration={presenter_duration:.6f}\n")
+        f.write(f"presentation_duration={presentation_duration:.6f}\n")
     logger.info("Properties written to: %s", outputfile)
 
 # Main execution
-status, fixed_type, offset = determine_sync_status(presenter, presentation)
-write_properties(status, fixed_type, offset, outputfile)
+status, fixed_type, offset, a1, a2 = determine_sync_status(presenter, presentation)
+write_properties(status, fixed_type, offset, outputfile, a1, a2)
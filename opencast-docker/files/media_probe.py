@@ -0,0 +1,67 @@
+# Duration probing shared by assign_flavor.py and sync_video.py
+import subprocess
+import json
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson parses ffprobe output faster, the standard library is the fallback
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# PyAV reads durations in-process, ffprobe is spawned only if it is missing or fails
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# Returns (audio stream duration, container duration). Both the PyAV and the ffprobe path
+# use the container duration when the audio stream does not report its own.
+def get_durations(filename):
+    logger.debug("Getting durations for: %s", filename)
+    if av is not None:
+        try:
+            with av.open(filename) as container:
+                stream = container.streams.audio[0]
+                container_duration = container.duration / av.time_base
+                if stream.duration:
+                    return float(stream.duration * stream.time_base), container_duration
+                logger.warning("No audio stream duration in %s, using container duration", filename)
+                return container_duration, container_duration
+        except (av.error.FFmpegError, IndexError, TypeError) as e:
+            logger.warning("PyAV could not read %s, falling back to ffprobe: %s", filename, e)
+
+    # stderr is only read for debug logging
+    debug = logger.isEnabledFor(logging.DEBUG)
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=duration:format=duration',
+        '-of', 'json=c=1',
+        filename
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE if debug else subprocess.DEVNULL)
+
+    if debug:
+        logger.debug("ffprobe stdout: %s", result.stdout)
+        logger.debug("ffprobe stderr: %s", result.stderr)
+
+    try:
+        info = json_loads(result.stdout)
+        stream = info['streams'][0]
+        container_duration = float(info['format']['duration'])
+        if 'duration' in stream:
+            return float(stream['duration']), container_duration
+        logger.warning("No audio stream duration in %s, using container duration", filename)
+        return container_duration, container_duration
+    except (KeyError, IndexError, ValueError, json.JSONDecodeError) as e:
+        logger.error("Failed to parse ffprobe output for %s: %s", filename, e)
+        sys.exit(1)
+
+# Probes both files side by side, the two lookups are independent
+def get_pair_durations(presenter, presentation):
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        return list(pool.map(get_durations, [presenter, presentation]))
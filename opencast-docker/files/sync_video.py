@@ -1,147 +1,157 @@
 #!/usr/bin/env python3
+import argparse
+import functools
 import subprocess
 import os
-import json
 import sys
 import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+
+from media_probe import get_pair_durations
 
 # Setup logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('SYNC_LOG_LEVEL', 'INFO').upper(),
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
 
-# Check argument length
-if len(sys.argv) < 4:
-    logger.error("Usage: audio_video_sync.py presenter.mp4 presentation.mp4 output.mp4")
-    sys.exit(1)
-
-presenter_input = sys.argv[1]
-presentation_input = sys.argv[2]
-outputfile = sys.argv[3]
-
-# Log inputs
-logger.debug("Working directory: %s", os.getcwd())
-logger.debug("Presenter input: %s", presenter_input)
-logger.debug("Presentation input: %s", presentation_input)
-logger.debug("Output file: %s", outputfile)
-
-# Validate input files
-for path in [presenter_input, presentation_input]:
-    if not os.path.exists(path):
-        logger.error("File not found: %s", path)
-        sys.exit(1)
-
-def get_audio_duration(filename):
-    logger.debug("Getting audio duration for: %s", filename)
-    result = subprocess.run([
-        'ffprobe', '-v', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=duration',
-        '-of', 'json',
-        filename
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    logger.debug("ffprobe stdout: %s", result.stdout)
-    logger.debug("ffprobe stderr: %s", result.stderr)
-
+# Returns the number of CPUs this process may use. os.cpu_count() reports all host cores,
+# inside a container the CPU affinity and the cgroup v2 quota are what actually applies.
+def available_cpus():
     try:
-        info = json.loads(result.stdout)
-        return float(info['streams'][0]['duration'])
-    except (KeyError, IndexError, ValueError, json.JSONDecodeError) as e:
-        logger.error("Failed to parse ffprobe output for audio: %s", e)
-        sys.exit(1)
-
-def get_video_duration(filename):
-    logger.debug("Getting video duration for: %s", filename)
-    result = subprocess.run([
-        'ffprobe', '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-of', 'json',
-        filename
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    logger.debug("ffprobe stdout: %s", result.stdout)
-    logger.debug("ffprobe stderr: %s", result.stderr)
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
 
     try:
-        info = json.loads(result.stdout)
-        return float(info['format']['duration'])
-    except (KeyError, IndexError, ValueError, json.JSONDecodeError) as e:
-        logger.error("Failed to parse ffprobe output for video: %s", e)
-        sys.exit(1)
-
-def create_offset_video(ref_video, offset_duration, resolution="1280x720", output="blank_with_audio.mp4"):
-    logger.info("Creating blank video of %.2fs using audio from: %s", offset_duration, ref_video)
-
+        with open('/sys/fs/cgroup/cpu.max', encoding="utf-8") as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+
+    return max(1, cpus)
+
+# Encoder threads, sized to the CPUs available to the container unless FFMPEG_THREADS is set
+def ffmpeg_threads():
+    return os.environ.get('FFMPEG_THREADS') or str(available_cpus())
+
+# Offsets below SYNC_THRESHOLD seconds are left alone, offsets above SYNC_MAX (disabled by default)
+# point to broken input
+SYNC_THRESHOLD = float(os.environ.get('SYNC_THRESHOLD', '0.1'))
+SYNC_MAX = float(os.environ.get('SYNC_MAX', 'inf'))
+
+# Hardware H.264 encoders in order of preference: (encoder, device node, global options, filters, encoder options).
+# Set FFMPEG_HWACCEL=none to always encode with libx264.
+RENDER_NODE = '/dev/dri/renderD128'
+HW_ENCODERS = [
+    ('h264_nvenc', '/dev/nvidia0', [], '', ['-preset', 'p4', '-tune', 'll']),
+    ('h264_vaapi', RENDER_NODE, ['-vaapi_device', RENDER_NODE], 'format=nv12,hwupload', []),
+    ('h264_qsv', RENDER_NODE, [], 'format=nv12', []),
+]
+
+# Parses the audio durations assign_flavor.py stored as workflow properties
+def parse_durations(values):
     try:
-        subprocess.run([
-            'ffmpeg', '-y',
-            '-i', ref_video,
-            '-t', str(offset_duration),
-            '-vn',
-            '-ar', '44100', '-ac', '2', '-b:a', '192k', '-acodec', 'aac',
-            'temp_offset_audio.aac'
-        ], check=True)
-
-        subprocess.run([
-            'ffmpeg', '-y',
-            '-f', 'lavfi', '-i', f'color=black:s={resolution}:d={offset_duration}',
-            '-i', 'temp_offset_audio.aac',
-            '-vf', f'scale={resolution},fps=25',
-            '-ar', '44100', '-ac', '2',
-            '-c:v', 'libx264', '-c:a', 'aac', '-b:a', '192k',
-            '-shortest', output
-        ], check=True)
-
-        if os.path.exists("temp_offset_audio.aac"):
-            os.remove("temp_offset_audio.aac")
-
-    except subprocess.CalledProcessError as e:
-        logger.error("Error during creating offset video: %s", e)
-        sys.exit(1)
+        return float(values[0]), float(values[1])
+    except ValueError as e:
+        logger.warning("Cannot use durations %s, probing instead: %s", values, e)
+        return None
 
-def reencode_video(video_path, output_path):
-    logger.info("Re-encoding video: %s -> %s", video_path, output_path)
-    try:
-        subprocess.run([
-            'ffmpeg', '-y',
-            '-i', video_path,
-            '-vf', 'scale=1280:720,fps=25',
-            '-ar', '44100', '-ac', '2',
-            '-c:v', 'libx264', '-c:a', 'aac', '-b:a', '192k',
-            output_path
-        ], check=True)
-    except subprocess.CalledProcessError as e:
-        logger.error("Error during re-encoding video: %s", e)
-        sys.exit(1)
-
-def concat_videos(video1, video2, output):
-    logger.info("Concatenating videos: %s + %s -> %s", video1, video2, output)
-    with open("concat_list.txt", "w") as f:
-        f.write(f"file '{os.path.abspath(video1)}'\n")
-        f.write(f"file '{os.path.abspath(video2)}'\n")
+# Returns the first hardware encoder that ffmpeg supports and whose device exists, or None
+@functools.lru_cache(maxsize=None)
+def pick_encoder():
+    if os.environ.get('FFMPEG_HWACCEL', 'auto') == 'none':
+        return None
 
     try:
-        subprocess.run([
-            'ffmpeg', '-y',
-            '-f', 'concat', '-safe', '0',
-            '-i', 'concat_list.txt',
-            '-c', 'copy',
-            output
-        ], check=True)
-        if os.path.exists("concat_list.txt"):
-            os.remove("concat_list.txt")
-    except subprocess.CalledProcessError as e:
-        logger.error("Error during concatenation: %s", e)
-        sys.exit(1)
-
-def auto_fix_offset(video_a, video_b, output="good_fixed.mp4", presenter="presenter.mp4", presentation="presentation.mp4"):
+        listing = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Cannot list ffmpeg encoders, using libx264: %s", e)
+        return None
+
+    for name, device, global_args, filters, encoder_args in HW_ENCODERS:
+        if f" {name} " in listing and os.path.exists(device):
+            logger.info("Using hardware encoder: %s", name)
+            return name, global_args, filters, encoder_args
+    return None
+
+# Returns (global options, filters, encoder options) for encoding video with the given encoder.
+# x264_args only apply to libx264, which is used when encoder is None.
+def video_encode_args(encoder, x264_args):
+    if encoder is None:
+        return [], '', ['-c:v', 'libx264'] + x264_args
+
+    name, global_args, filters, encoder_args = encoder
+    return global_args, filters, ['-c:v', name] + encoder_args
+
+# Prepends offset seconds of black video with the reference audio to the desynced video.
+# Everything happens in one ffmpeg run: both segments are normalized to 1280x720 at 25 fps
+# with 44.1 kHz stereo audio, joined by the concat filter and encoded once.
+def fix_offset(ref_video, desynced_video, offset_duration, output, resolution="1280x720"):
+    logger.info("Prepending %.2fs of black video with audio from %s to %s", offset_duration, ref_video, desynced_video)
+
+    audio_format = 'aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo'
+    width, height = resolution.split('x')
+
+    # A listed encoder with an existing device node can still fail, e.g. without the driver
+    # libraries in the container, so a failed hardware encode is retried once with libx264
+    encoders = [pick_encoder()]
+    if encoders[0] is not None:
+        encoders.append(None)
+
+    for encoder in encoders:
+        global_args, hw_filters, video_args = video_encode_args(encoder, ['-preset', 'veryfast'])
+        filters = [
+            '[0:v]format=yuv420p,setsar=1[lead_v]',
+            f'[1:a]{audio_format}[lead_a]',
+            f'[2:v]scale={width}:{height},fps=25,format=yuv420p,setsar=1[main_v]',
+            f'[2:a]{audio_format}[main_a]',
+            '[lead_v][lead_a][main_v][main_a]concat=n=2:v=1:a=1[v][a]',
+        ]
+        video_out = '[v]'
+        if hw_filters:
+            filters.append(f'[v]{hw_filters}[v_hw]')
+            video_out = '[v_hw]'
+
+        try:
+            subprocess.run([
+                'ffmpeg', '-y', *global_args,
+                '-f', 'lavfi', '-i', f'color=black:s={resolution}:r=25:d={offset_duration}',
+                '-t', str(offset_duration), '-i', ref_video,
+                '-i', desynced_video,
+                '-filter_complex', ';'.join(filters),
+                '-map', video_out, '-map', '[a]',
+                *video_args, '-threads', ffmpeg_threads(),
+                '-c:a', 'aac', '-b:a', '192k',
+                output
+            ], check=True)
+            return
+        except subprocess.CalledProcessError as e:
+            if encoder is not None:
+                logger.warning("Hardware encoder %s failed, retrying with libx264: %s", encoder[0], e)
+                continue
+            logger.error("Error during fixing offset: %s", e)
+            # Do not leave a truncated video behind for the workflow to pick up
+            with suppress(FileNotFoundError):
+                os.unlink(output)
+            sys.exit(1)
+
+def auto_fix_offset(video_a, video_b, output="good_fixed.mp4", presenter="presenter.mp4", presentation="presentation.mp4", durations=None):
     logger.info("=== Starting Sync Check ===")
 
-    a1 = get_audio_duration(video_a)
-    a2 = get_audio_duration(video_b)
+    if durations:
+        a1, a2 = durations
+    else:
+        (a1, v1), (a2, v2) = get_pair_durations(video_a, video_b)
+        logger.info("Video Durations -> Presenter: %.2fs, Presentation: %.2fs", v1, v2)
 
     logger.info("Audio Durations -> Presenter: %.2fs, Presentation: %.2fs", a1, a2)
 
@@ -149,7 +159,7 @@ def auto_fix_offset(video_a, video_b, output="good_fixed.mp4", presenter="presen
     offset = 0
     fixed_type = "none"
 
-    if abs(a1 - a2) < 0.1:
+    if abs(a1 - a2) < SYNC_THRESHOLD:
         logger.info("No sync adjustment needed.")
     else:
         status = "fix-needed"
@@ -170,31 +180,122 @@ def auto_fix_offset(video_a, video_b, output="good_fixed.mp4", presenter="presen
         else:
             fixed_type = "unknown"
 
+        if offset > SYNC_MAX:
+            logger.error("Offset of %.2fs exceeds the maximum of %.2fs, refusing to fix.", offset, SYNC_MAX)
+            sys.exit(1)
+
         logger.info("Fixing sync issue for %s with offset %.2fs", fixed_type, offset)
-        create_offset_video(ref, offset_duration=offset, output="blank_with_audio.mp4")
-        reencode_video(desynced, "desynced_fixed.mp4")
-        concat_videos("blank_with_audio.mp4", "desynced_fixed.mp4", output)
+        # Encode next to the final path and rename once complete, so a crashed run
+        # never leaves a half-written video under the name the workflow expects
+        root, ext = os.path.splitext(output)
+        partial_output = f"{root}.partial{ext}"
+        fix_offset(ref, desynced, offset, partial_output)
+
+        if not os.path.exists(partial_output) or os.path.getsize(partial_output) < 10000:
+            logger.error("Fixed video was not created or is too small.")
+            with suppress(FileNotFoundError):
+                os.unlink(partial_output)
+            sys.exit(1)
+
+        os.replace(partial_output, output)
+        logger.info("Output saved as: %s", output)
 
-        for temp_file in ["blank_with_audio.mp4", "desynced_fixed.mp4"]:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+    return status
 
-        logger.info("Output saved as: %s", output)
+def validate_inputs(presenter_input, presentation_input, outputfile):
+    # Log inputs
+    logger.debug("Working directory: %s", os.getcwd())
+    logger.debug("Presenter input: %s", presenter_input)
+    logger.debug("Presentation input: %s", presentation_input)
+    logger.debug("Output file: %s", outputfile)
+
+    # Validate input files
+    for path in [presenter_input, presentation_input]:
+        if not os.path.exists(path):
+            logger.error("File not found: %s", path)
+            sys.exit(1)
+
+# Processes one (presenter, presentation, output) triple of a batch, returns whether it succeeded
+def run_one(triple):
+    presenter_input, presentation_input, outputfile = triple
+    try:
+        validate_inputs(presenter_input, presentation_input, outputfile)
+        # A pair that is already in sync needs no output and counts as success
+        status = auto_fix_offset(presenter_input, presentation_input, outputfile, presenter_input, presentation_input)
+        logger.info("Sync status for %s: %s", outputfile, status)
+        return True
+    except SystemExit:
+        logger.error("Sync failed for: %s", outputfile)
+        return False
+    except Exception:
+        logger.exception("Sync failed for: %s", outputfile)
+        return False
+
+# Reads tab separated presenter, presentation and output paths, one triple per line
+def read_batch(filename):
+    triples = []
+    with open(filename, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != 3:
+                logger.error("Expected 3 tab separated fields in %s line %d", filename, number)
+                sys.exit(1)
+            triples.append(tuple(fields))
+    return triples
+
+def main():
+    parser = argparse.ArgumentParser(description="Fix the audio offset between presenter and presentation video")
+    parser.add_argument('presenter', nargs='?')
+    parser.add_argument('presentation', nargs='?')
+    parser.add_argument('output', nargs='?')
+    parser.add_argument('--durations', nargs=2, metavar=('PRESENTER', 'PRESENTATION'),
+                        help="audio durations reported by assign_flavor.py, used instead of probing the inputs")
+    parser.add_argument('--batch',
+                        help="TSV file with presenter, presentation and output paths to process in one run")
+    parser.add_argument('--concurrency', type=int, default=max(1, available_cpus() // 4),
+                        help="number of pairs processed in parallel in batch mode")
+    args = parser.parse_args()
+
+    if args.batch:
+        triples = read_batch(args.batch)
+        concurrency = max(1, args.concurrency)
+        # Every worker runs its own ffmpeg, so the CPUs are split between them
+        if not os.environ.get('FFMPEG_THREADS'):
+            os.environ['FFMPEG_THREADS'] = str(max(1, available_cpus() // concurrency))
+        with ProcessPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(run_one, triples))
+        failed = results.count(False)
+        logger.info("=== Batch Completed: %d of %d pairs synced ===", len(results) - failed, len(results))
+        if failed:
+            sys.exit(1)
+        return
+
+    if not (args.presenter and args.presentation and args.output):
+        parser.error("presenter, presentation and output are required unless --batch is given")
+
+    validate_inputs(args.presenter, args.presentation, args.output)
+
+    # Run the function
+    auto_fix_offset(
+        args.presenter,
+        args.presentation,
+        args.output,
+        args.presenter,
+        args.presentation,
+        parse_durations(args.durations) if args.durations else None
+    )
 
     with open("/tmp/video_params.log", "w") as f:
         f.write(" ".join(sys.argv))
 
-    if not os.path.exists(output) or os.path.getsize(output) < 10000:
+    if not os.path.exists(args.output) or os.path.getsize(args.output) < 10000:
         logger.error("Final output video was not created or is too small.")
         sys.exit(1)
 
-# Run the function
-auto_fix_offset(
-    presenter_input,
-    presentation_input,
-    outputfile,
-    presenter_input,
-    presentation_input
-)
+    logger.info("=== Script Completed ===")
 
-logger.info("=== Script Completed ===")
+if __name__ == "__main__":
+    main()